@@ -16,11 +16,22 @@
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import os
 import platform
+import shlex
+import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+
+# Fail early, rather than partway through a build, on interpreters without
+# `shlex.join`, which is used to log the executed commands.
+if sys.version_info < (3, 8):
+    sys.exit('build-script-helper.py requires Python 3.8 or later')
 
 
 def printerr(message):
@@ -73,8 +84,13 @@ def parse_args(args):
              'template to.')
     parser.add_argument(
         "--cross-compile-hosts", dest="cross_compile_hosts",
-        help="List of cross compile hosts targets.", default=[])
+        help="List of cross compile hosts targets.", default='')
     parser.add_argument('--install-only', action='store_true', default=False)
+    parser.add_argument(
+        '--parallel-actions', action='store_true', default=False,
+        help='Generate the Xcode project concurrently with the other actions, '
+             'using a separate "<build-dir>/generate-xcodeproj" scratch path. '
+             'Ignored with --no-local-deps.')
 
     parsed = parser.parse_args(args)
 
@@ -88,6 +104,17 @@ def parse_args(args):
     if not parsed.build_dir:
         parsed.build_dir = os.path.join(parsed.package_path, '.build')
 
+    # Only universal macOS builds are supported. Reject anything else up front
+    # instead of building for the host and failing later.
+    parsed.cross_compile_hosts = \
+        parsed.cross_compile_hosts.replace(',', ' ').split()
+    if parsed.cross_compile_hosts and not (
+            platform.system() == 'Darwin'
+            and all(host.startswith('macosx-')
+                    for host in parsed.cross_compile_hosts)):
+        parser.error("cannot cross-compile for %s"
+                     % ', '.join(parsed.cross_compile_hosts))
+
     return parsed
 
 
@@ -110,9 +137,29 @@ def run(args):
                 verbose=args.verbose)
         except subprocess.CalledProcessError as e:
             printerr('FAIL: Updating dependencies of %s failed' % package_name)
-            printerr('Executing: %s' % ' '.join(e.cmd))
+            printerr('Executing: %s' % shlex.join(e.cmd))
             sys.exit(1)
 
+    # Tell Swift-DocC that we are building in a build-script environment so
+    # that it does not need to be rebuilt if it has already been built before.
+    env['SWIFT_BUILD_SCRIPT_ENVIRONMENT'] = '1'
+
+    generate_xcodeproj_future = None
+    if (args.parallel_actions and not args.no_local_deps
+            and should_run_action('generate-xcodeproj', args.build_actions)):
+        # The build, test, and install actions share the same SwiftPM scratch
+        # path and run one after the other. Give the Xcode project generation
+        # its own scratch path so that it can overlap with them instead of
+        # contending for the same build directory. This is only safe with
+        # local dependencies. Remote dependencies would be cloned again into
+        # the separate scratch path, and both SwiftPM processes could resolve
+        # the package's Package.resolved file at the same time.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        generate_xcodeproj_future = executor.submit(
+            run_generate_xcodeproj, args, env, package_name,
+            os.path.join(args.build_dir, 'generate-xcodeproj'))
+        executor.shutdown(wait=False)
+
     # The test action creates its own build. No need to build if we are just
     # testing.
     if should_run_action('build', args.build_actions):
@@ -126,21 +173,12 @@ def run(args):
                 swiftpm_args=get_swiftpm_options('build', args))
         except subprocess.CalledProcessError as e:
             printerr('FAIL: Building %s failed' % package_name)
-            printerr('Executing: %s' % ' '.join(e.cmd))
+            printerr('Executing: %s' % shlex.join(e.cmd))
             sys.exit(1)
 
-    if should_run_action('generate-xcodeproj', args.build_actions):
-        print("** Generating Xcode project for %s **" % package_name)
-        try:
-            generate_xcodeproj(
-                args.package_path,
-                swift_exec=args.swift_exec,
-                env=env,
-                verbose=args.verbose)
-        except subprocess.CalledProcessError as e:
-            printerr('FAIL: Generating the Xcode project failed')
-            printerr('Executing: %s' % ' '.join(e.cmd))
-            sys.exit(1)
+    if (should_run_action('generate-xcodeproj', args.build_actions)
+            and generate_xcodeproj_future is None):
+        run_generate_xcodeproj(args, env, package_name)
 
     if should_run_action('test', args.build_actions):
         print("** Testing %s **" % package_name)
@@ -153,7 +191,7 @@ def run(args):
                 swiftpm_args=get_swiftpm_options('test', args))
         except subprocess.CalledProcessError as e:
             printerr('FAIL: Testing %s failed' % package_name)
-            printerr('Executing: %s' % ' '.join(e.cmd))
+            printerr('Executing: %s' % shlex.join(e.cmd))
             sys.exit(1)
 
     if should_run_action('install', args.build_actions):
@@ -170,9 +208,28 @@ def run(args):
             install(args, env)
         except subprocess.CalledProcessError as e:
             printerr('FAIL: Installing %s failed' % package_name)
-            printerr('Executing: %s' % ' '.join(e.cmd))
+            printerr('Executing: %s' % shlex.join(e.cmd))
             sys.exit(1)
 
+    if generate_xcodeproj_future is not None:
+        # Wait for the Xcode project and propagate its exit on failure.
+        generate_xcodeproj_future.result()
+
+
+def run_generate_xcodeproj(args, env, package_name, scratch_path=None):
+    print("** Generating Xcode project for %s **" % package_name)
+    try:
+        generate_xcodeproj(
+            args.package_path,
+            swift_exec=args.swift_exec,
+            env=env,
+            verbose=args.verbose,
+            scratch_path=scratch_path)
+    except subprocess.CalledProcessError as e:
+        printerr('FAIL: Generating the Xcode project failed')
+        printerr('Executing: %s' % shlex.join(e.cmd))
+        sys.exit(1)
+
 
 def should_run_action(action_name, selected_actions):
     if action_name in selected_actions:
@@ -243,13 +300,15 @@ def get_swiftpm_options(action, args):
         if action == 'install':
             swiftpm_args += ['--disable-local-rpath']
 
-    cross_compile_hosts = args.cross_compile_hosts
-    if cross_compile_hosts:
-        if (build_os.startswith('macosx')
-                and cross_compile_hosts.startswith('macosx-')):
-            swiftpm_args += ["--arch", "x86_64", "--arch", "arm64"]
-        else:
-            printerr("cannot cross-compile for %s" % cross_compile_hosts)
+    jobs = get_job_count()
+    if args.cross_compile_hosts:
+        # The cross compile hosts are validated in `parse_args`.
+        swiftpm_args += ["--arch", "x86_64", "--arch", "arm64"]
+        # Both architectures build at the same time, so split the available
+        # cores between them.
+        jobs = max(1, jobs // 2)
+
+    swiftpm_args += ['--jobs', str(jobs)]
 
     if action == 'install' or action == 'show-bin-path':
         # When tests are run on the host machine, `docc` is located in the
@@ -269,6 +328,25 @@ def get_swiftpm_options(action, args):
     return swiftpm_args
 
 
+def get_job_count():
+    """Returns the number of parallel build jobs to pass to SwiftPM."""
+    jobs = os.environ.get('SWIFTPM_JOBS')
+    if jobs:
+        try:
+            job_count = int(jobs)
+        except ValueError:
+            job_count = 0
+        if job_count < 1:
+            fatal_error("SWIFTPM_JOBS must be a positive integer, not '%s'"
+                        % jobs)
+        return job_count
+    # Only count the cores that this process is allowed to run on, where
+    # supported, rather than all the cores of the machine.
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def invoke_swift(action, products, env, args, swiftpm_args):
     # Until rdar://53881101 is implemented, we cannot request a build of
     # multiple targets simultaneously. For now, just build one product after
@@ -301,19 +379,17 @@ def invoke_swift_single_product(action, product, env, args, swiftpm_args):
         swiftpm_args=swiftpm_args
     )
 
-    # Tell Swift-DocC that we are building in a build-script environment so
-    # that it does not need to be rebuilt if it has already been built before.
-    env['SWIFT_BUILD_SCRIPT_ENVIRONMENT'] = '1'
-
     check_call(call, env=env, verbose=args.verbose)
 
 
-def generate_xcodeproj(package_path, swift_exec, env, verbose):
+def generate_xcodeproj(package_path, swift_exec, env, verbose,
+                       scratch_path=None):
     package_name = os.path.basename(package_path)
     xcodeproj_path = os.path.join(package_path, '%s.xcodeproj' % package_name)
-    args = [
-        swift_exec, 'package',
-        '--package-path', package_path,
+    args = [swift_exec, 'package', '--package-path', package_path]
+    if scratch_path:
+        args += ['--scratch-path', scratch_path]
+    args += [
         'generate-xcodeproj',
         '--output', xcodeproj_path,
     ]
@@ -332,12 +408,10 @@ def install(args, env):
         verbose=verbose
     )
 
-    create_intermediate_directories(
-        os.path.dirname(docc_install_dir), verbose=verbose)
+    create_intermediate_directories(os.path.dirname(docc_install_dir))
     check_and_sync(
         file_path=docc_path,
-        install_path=docc_install_dir,
-        verbose=verbose
+        install_path=docc_install_dir
     )
 
     features_path = os.path.join(args.package_path, 'features.json')
@@ -349,16 +423,14 @@ def install(args, env):
         'docc',
         'features.json'
     )
-    create_intermediate_directories(
-        os.path.dirname(features_install_path), verbose=verbose)
+    create_intermediate_directories(os.path.dirname(features_install_path))
     check_and_sync(
         file_path=features_path,
-        install_path=features_install_path,
-        verbose=verbose
+        install_path=features_install_path
     )
 
-    # Copy the content of the build_dir into the install dir with a call like
-    # rsync -a src/ dest
+    # Copy the content of the build_dir into the install dir, like
+    # `rsync -a src/ dest`
     copy_render_from = args.copy_doccrender_from
     copy_render_to = args.copy_doccrender_to
 
@@ -368,11 +440,10 @@ def install(args, env):
                 "Missing required '--copy-doccrender-to' argument since "
                 "'--copy-doccrender-from' was passed.")
         from_dir_with_trailing_slash = os.path.join(copy_render_from, '')
-        create_intermediate_directories(copy_render_to, verbose=verbose)
+        create_intermediate_directories(copy_render_to)
         check_and_sync(
             file_path=from_dir_with_trailing_slash,
-            install_path=copy_render_to,
-            verbose=verbose
+            install_path=copy_render_to
         )
 
 
@@ -381,10 +452,13 @@ def get_build_target(args):
     compilation."""
     # Adapted from
     # https://github.com/swiftlang/swift-package-manager/blob/fde9916d/Utilities/bootstrap#L296
-    command = [args.swift_exec, '-print-target-info']
-    target_info_json = subprocess.check_output(
-        command, stderr=subprocess.PIPE, universal_newlines=True).strip()
-    args.target_info = json.loads(target_info_json)
+    # The target info doesn't change between calls, so only query the swift
+    # driver the first time.
+    if getattr(args, 'target_info', None) is None:
+        command = [args.swift_exec, '-print-target-info']
+        target_info_json = subprocess.check_output(
+            command, stderr=subprocess.PIPE, universal_newlines=True).strip()
+        args.target_info = json.loads(target_info_json)
     if '-apple-macosx' in args.target_info["target"]["unversionedTriple"]:
         return args.target_info["target"]["unversionedTriple"]
 
@@ -392,6 +466,25 @@ def get_build_target(args):
 
 
 def docc_bin_path(args, env, verbose):
+    if getattr(args, 'docc_bin_path', None) is not None:
+        return args.docc_bin_path
+
+    # SwiftPM's native build system places the built products in
+    # "<scratch-path>/<target-triple>/<configuration>". Universal macOS builds
+    # and multiroot builds use XCBuild, which has a different layout, so ask
+    # SwiftPM for the location of those, or if the executable isn't where it's
+    # expected to be.
+    if not args.cross_compile_hosts and not args.multiroot_data_file:
+        path = os.path.join(
+            args.build_dir,
+            get_build_target(args),
+            args.configuration,
+            'docc'
+        )
+        if os.path.exists(path):
+            args.docc_bin_path = path
+            return path
+
     cmd = get_call_to_invoke_swift_single_product(
         action='build',
         product='docc',
@@ -403,34 +496,138 @@ def docc_bin_path(args, env, verbose):
     )
 
     if verbose:
-        print(' '.join([escape_cmd_arg(arg) for arg in cmd]))
-    return os.path.join(
+        print(shlex.join(cmd))
+    args.docc_bin_path = os.path.join(
         subprocess.check_output(cmd, env=env).strip().decode(), 'docc')
-
-
-def create_intermediate_directories(dir_path, verbose):
-    cmd = ["mkdir", "-p", dir_path]
-    print("-- note: creating intermediate directories %s: %s"
-          % (dir_path, " ".join(cmd)))
-    result = check_call(cmd, verbose=verbose)
-    if result != 0:
-        fatal_error(
-            "creating intermediate directories failed with exit status %d"
-            % (result,))
-
-
-def check_and_sync(file_path, install_path, verbose):
-    cmd = ["rsync", "-a", file_path, install_path]
-    print("-- note: installing %s: %s"
-          % (os.path.basename(file_path), " ".join(cmd)))
-    result = check_call(cmd, verbose=verbose)
-    if result != 0:
-        fatal_error("install failed with exit status %d" % (result,))
+    return args.docc_bin_path
+
+
+def create_intermediate_directories(dir_path):
+    print("-- note: creating intermediate directories %s" % dir_path)
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+    except OSError as e:
+        fatal_error("creating intermediate directories failed: %s" % e)
+
+
+def check_and_sync(file_path, install_path):
+    # Like `rsync -a`, a source path with a trailing slash copies the
+    # directory's content rather than the directory itself.
+    is_directory_copy = file_path.endswith(os.sep)
+    file_name = os.path.basename(os.path.normpath(file_path))
+
+    if not is_directory_copy:
+        destination_path = install_path
+        if os.path.isdir(destination_path):
+            destination_path = os.path.join(install_path, file_name)
+        if has_same_content(file_path, destination_path):
+            print("-- note: %s is up-to-date at %s"
+                  % (file_name, destination_path))
+            # Like `rsync -a`, still update the permissions and times.
+            try:
+                shutil.copystat(file_path, destination_path)
+            except OSError as e:
+                fatal_error("install failed: %s" % e)
+            return
+
+    print("-- note: installing %s to %s" % (file_name, install_path))
+    try:
+        if is_directory_copy:
+            copy_directory_content(file_path, install_path)
+        else:
+            install_file(file_path, destination_path)
+    except OSError as e:
+        fatal_error("install failed: %s" % e)
+
+
+def copy_directory_content(source_dir, install_dir):
+    """Copies the content of a directory into another directory, like
+    `rsync -a source_dir/ install_dir`."""
+    for root, dir_names, file_names in os.walk(source_dir):
+        install_root = os.path.normpath(
+            os.path.join(install_dir, os.path.relpath(root, source_dir)))
+        os.makedirs(install_root, exist_ok=True)
+        shutil.copystat(root, install_root)
+        for name in dir_names + file_names:
+            path = os.path.join(root, name)
+            # `os.walk` descends into the real directories but not into
+            # symlinked directories, which are copied as links.
+            if name in dir_names and not os.path.islink(path):
+                continue
+            copy_if_modified(path, os.path.join(install_root, name))
+
+
+def install_file(file_path, install_path):
+    """Copies a file, or a symlink as a link, to the install path, replacing
+    any existing file or link there."""
+    # Like `rsync`, write to a temporary file next to the destination and
+    # rename it over the destination. Rewriting the existing file in place
+    # fails with ETXTBSY on Linux if it's running, and makes macOS kill
+    # signed executables because their code signature no longer matches.
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(install_path) or os.curdir,
+        prefix='.%s.' % os.path.basename(install_path))
+    os.close(fd)
+    try:
+        if os.path.islink(file_path):
+            # `os.symlink` doesn't replace the placeholder temporary file.
+            os.remove(temp_path)
+            os.symlink(os.readlink(file_path), temp_path)
+        else:
+            shutil.copy2(file_path, temp_path)
+        os.replace(temp_path, install_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def has_same_content(file_path, other_file_path):
+    """Returns whether the two paths are regular files with the same
+    content."""
+    for path in [file_path, other_file_path]:
+        if os.path.islink(path) or not os.path.isfile(path):
+            return False
+    if os.path.getsize(file_path) != os.path.getsize(other_file_path):
+        return False
+    return file_digest(file_path) == file_digest(other_file_path)
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def copy_if_modified(file_path, install_path):
+    """Installs a file like `install_file` unless the destination is a
+    regular file with the same size and modification time, like rsync's
+    quick check. The permissions of a skipped file are still updated."""
+    try:
+        file_stat = os.lstat(file_path)
+        install_stat = os.lstat(install_path)
+        if (stat.S_ISREG(file_stat.st_mode)
+                and stat.S_ISREG(install_stat.st_mode)
+                and file_stat.st_size == install_stat.st_size
+                and file_stat.st_mtime_ns == install_stat.st_mtime_ns):
+            if file_stat.st_mode != install_stat.st_mode:
+                shutil.copymode(file_path, install_path)
+            return
+    except FileNotFoundError:
+        pass
+    install_file(file_path, install_path)
 
 
 def check_call(cmd, verbose, env=os.environ, **kwargs):
     if verbose:
-        print(' '.join([escape_cmd_arg(arg) for arg in cmd]))
+        print(shlex.join(cmd))
+    # The child process writes directly to the inherited stdout. Flush what
+    # this script printed so far so that it isn't held back in Python's buffer
+    # and interleaved out of order with the child's output when stdout is a
+    # pipe, for example when a CI system collects the log.
+    sys.stdout.flush()
     return subprocess.check_call(
         cmd, env=env, stderr=subprocess.STDOUT, **kwargs)
 
@@ -440,12 +637,5 @@ def fatal_error(message):
     sys.exit(1)
 
 
-def escape_cmd_arg(arg):
-    if '"' in arg or ' ' in arg:
-        return '"%s"' % arg.replace('"', '\\"')
-    else:
-        return arg
-
-
 if __name__ == '__main__':
     main()